@@ -2,16 +2,24 @@
 # Run CTest in two passes.
 #
 # Pass 1: quiet run to quickly identify failing tests.
-# Pass 2: re-run each failing test individually with full verbosity.
+# Pass 2: re-run the failing tests with full verbosity, in a single ctest
+#         invocation whose output is split per test. With --no-batched-pass2
+#         each test is rerun on its own, in parallel (see --jobs).
+#         --pause reruns tests one by one.
 #
 # Typical usage:
 #   bash scripts/ctest_2pass.sh --build-dir build
 #   bash scripts/ctest_2pass.sh --build-dir build -- -j8
+#   bash scripts/ctest_2pass.sh --build-dir build --jobs 4
+#   bash scripts/ctest_2pass.sh --build-dir build --grep surrounding
 #   bash scripts/ctest_2pass.sh --build-dir build --env GLOG_v=2 -- --timeout 120
 #
 # Notes:
 # - This script relies on CTest producing Testing/Temporary/LastTestsFailed.log.
 # - Extra arguments after "--" are passed to BOTH passes.
+# - Unless -j/--parallel is passed, CTest runs with "-j N" where N is --jobs,
+#   or (cores - 2) if CTEST_PARALLEL_LEVEL is not set; see --no-auto-jobs.
+# - The environment is passed through untouched unless --env is given.
 
 set -euo pipefail
 
@@ -20,6 +28,12 @@ BUILD_DIR="build"
 PAUSE=0
 NO_SECOND_PASS=0
 NO_CASE_PASS=0
+JOBS=""
+AUTO_JOBS=1
+BATCHED=1
+GREP=""
+EARLY_RERUN=0
+declare -a ONLY_LABELS=()
 declare -a ENV_VARS=()
 declare -a CTEST_ARGS=()
 
@@ -29,6 +43,19 @@ GREEN='\033[0;32m'
 YELLOW='\033[1;33m'
 NC='\033[0m' # No Color
 
+# Longest "-R" alternation used for a batched PASS 2 run. CTest's regular
+# expression engine rejects patterns that compile too big.
+BATCH_REGEX_MAX=4096
+
+# Seconds between checks of the PASS 1 log with --early-rerun
+EARLY_POLL_INTERVAL=2
+
+# Case marker printed by the tests after "<test name>:",
+# e.g. "testsurroundingtext: Case 20"
+CASE_PATTERN='^[[:space:]]*Case[[:space:]]+[0-9]+'
+# How much of the end of a test log is searched first for the failing case
+CASE_SCAN_TAIL_BYTES=262144
+
 usage() {
     cat <<EOF
 Usage: $(basename "$0") [OPTIONS] [-- CTEST_ARGS...]
@@ -39,9 +66,25 @@ Run CTest in 2 passes: (1) quiet to identify failures;
 OPTIONS:
     --build-dir DIR       CMake build directory (default: build)
     --pause               Wait for Enter between failed-test reruns
+                          (reruns are serial; otherwise they run in parallel)
     --env KEY=VALUE       Set environment variable for BOTH passes (repeatable)
     --no-second-pass      Only run first pass and print failed test list
     --no-case-pass        Do not attempt case-only rerun
+    --jobs N              Number of parallel CTest jobs and PASS 2 workers
+                          (default: -j/--parallel from CTEST_ARGS, then
+                          CTEST_PARALLEL_LEVEL, then number of cores - 2)
+    --no-auto-jobs        Do not pass -j to CTest unless --jobs is given
+    --batched-pass2       Rerun all failed tests in one ctest invocation and
+                          split its output per test (default unless --pause)
+    --no-batched-pass2    Rerun failed tests with one ctest invocation each
+    --only LABEL          Only rerun failed tests with a CTest label matching
+                          LABEL (repeatable, any label matches)
+    --grep REGEX          Only rerun failed tests whose name matches REGEX
+                          (extended regular expression)
+    --early-rerun         Start rerunning failed tests while PASS 1 is still
+                          running (reruns tests individually, in parallel).
+                          The reruns overwrite Testing/Temporary/LastTest*.log;
+                          the PASS 1 output is kept in the logs dir
     -h, --help            Show this help message
 
 CTEST_ARGS:
@@ -72,6 +115,34 @@ while [[ $# -gt 0 ]]; do
             NO_CASE_PASS=1
             shift
             ;;
+        --jobs)
+            JOBS="$2"
+            shift 2
+            ;;
+        --no-auto-jobs)
+            AUTO_JOBS=0
+            shift
+            ;;
+        --batched-pass2)
+            BATCHED=1
+            shift
+            ;;
+        --no-batched-pass2)
+            BATCHED=0
+            shift
+            ;;
+        --only)
+            ONLY_LABELS+=("$2")
+            shift 2
+            ;;
+        --grep)
+            GREP="$2"
+            shift 2
+            ;;
+        --early-rerun)
+            EARLY_RERUN=1
+            shift
+            ;;
         -h|--help)
             usage
             exit 0
@@ -100,10 +171,29 @@ if [[ ! -f "$BUILD_DIR/CTestTestfile.cmake" && ! -f "$BUILD_DIR/CMakeCache.txt"
     exit 2
 fi
 
+if [[ -n "$JOBS" && ! "$JOBS" =~ ^[1-9][0-9]*$ ]]; then
+    echo "Error: Invalid --jobs value '$JOBS'. Expected a positive integer" >&2
+    exit 2
+fi
+
+if [[ $EARLY_RERUN -eq 1 && ( $PAUSE -eq 1 || $NO_SECOND_PASS -eq 1 ) ]]; then
+    echo "Error: --early-rerun cannot be combined with --pause or --no-second-pass" >&2
+    exit 2
+fi
+
 BUILD_DIR=$(cd "$BUILD_DIR" && pwd)
+# Every ctest invocation runs from the build directory; changing into it once
+# saves forking a "cd" subshell around each of them
+cd "$BUILD_DIR"
 LOGS_DIR="$BUILD_DIR/.ctest-2pass"
 mkdir -p "$LOGS_DIR"
 
+# Output of "ctest -N -V", generated at most once per invocation
+TEST_LIST_CACHE="$LOGS_DIR/ctest-tests.log"
+rm -f "$TEST_LIST_CACHE"
+# Leftovers of an interrupted run would confuse the PASS 2 workers
+rm -f "$LOGS_DIR"/.pass2.*
+
 # Set environment variables
 for env_var in "${ENV_VARS[@]}"; do
     if [[ ! "$env_var" =~ = ]]; then
@@ -113,6 +203,126 @@ for env_var in "${ENV_VARS[@]}"; do
     export "$env_var"
 done
 
+# Default parallelism: number of cores minus 2, at least 1
+default_jobs() {
+    local n
+    n=$(nproc 2>/dev/null || getconf _NPROCESSORS_ONLN 2>/dev/null || echo 2)
+    n=$((n - 2))
+    if [[ $n -lt 1 ]]; then
+        n=1
+    fi
+    echo "$n"
+}
+
+# Check whether the extra ctest arguments already select a parallel level
+has_parallel_arg() {
+    local arg
+    for arg in "${CTEST_ARGS[@]}"; do
+        case "$arg" in
+            -j|-j*|--parallel|--parallel=*)
+                return 0
+                ;;
+        esac
+    done
+    return 1
+}
+
+# Print the level given to -j/--parallel in the extra ctest arguments, or
+# nothing if there is none or it has no value
+parallel_arg_level() {
+    local i arg level=""
+    for (( i = 0; i < ${#CTEST_ARGS[@]}; i++ )); do
+        arg="${CTEST_ARGS[$i]}"
+        case "$arg" in
+            -j|--parallel)
+                level="${CTEST_ARGS[$((i+1))]:-}"
+                ;;
+            --parallel=*)
+                level="${arg#--parallel=}"
+                ;;
+            -j*)
+                level="${arg#-j}"
+                ;;
+            *)
+                continue
+                ;;
+        esac
+        break
+    done
+    if [[ "$level" =~ ^[1-9][0-9]*$ ]]; then
+        echo "$level"
+    fi
+}
+
+# Number of parallel jobs, used for PASS 1's -j and for the PASS 2 worker
+# pool: --jobs, then -j/--parallel among the extra ctest arguments, then
+# CTEST_PARALLEL_LEVEL, then the number of cores minus 2
+WORKERS="$JOBS"
+if [[ -z "$WORKERS" ]]; then
+    WORKERS=$(parallel_arg_level)
+fi
+if [[ -z "$WORKERS" && "${CTEST_PARALLEL_LEVEL:-}" =~ ^[1-9][0-9]*$ ]]; then
+    WORKERS="$CTEST_PARALLEL_LEVEL"
+fi
+if [[ -z "$WORKERS" ]]; then
+    WORKERS=$(default_jobs)
+fi
+
+# Let CTest run tests in parallel unless the user already chose a level.
+# An explicit --jobs always applies, unless -j is among the extra ctest
+# arguments; CTEST_PARALLEL_LEVEL only disables the automatic level.
+# This is passed as "-j N" to the ctest runs that execute several tests
+# rather than exported, so the environment seen by tests stays inherited.
+declare -a AUTO_JOBS_ARGS=()
+if ! has_parallel_arg; then
+    if [[ -n "$JOBS" ]]; then
+        AUTO_JOBS_ARGS=(-j "$JOBS")
+    elif [[ $AUTO_JOBS -eq 1 && -z "${CTEST_PARALLEL_LEVEL:-}" ]]; then
+        AUTO_JOBS_ARGS=(-j "$WORKERS")
+    fi
+fi
+
+# Escape CTest regular expression metacharacters in each input line, so
+# test names match literally
+escape_regex() {
+    sed 's/[][\\.^$*+?(){}|]/\\&/g'
+}
+
+# Regex-escaped test names, filled once per name by escape_test_names
+declare -A ESCAPED_TEST_NAMES=()
+
+# Escape the given test names that are not escaped yet, in a single pass
+escape_test_names() {
+    local -a names=() escaped=()
+    local test i
+
+    for test in "$@"; do
+        if [[ -z "${ESCAPED_TEST_NAMES[$test]:-}" ]]; then
+            names+=("$test")
+        fi
+    done
+    if [[ ${#names[@]} -eq 0 ]]; then
+        return
+    fi
+
+    mapfile -t escaped < <(printf '%s\n' "${names[@]}" | escape_regex)
+    for i in "${!names[@]}"; do
+        ESCAPED_TEST_NAMES[${names[$i]}]="${escaped[$i]}"
+    done
+}
+
+# Print arguments one per line, dropping duplicates while preserving order
+print_unique() {
+    local -A seen=()
+    local item
+    for item in "$@"; do
+        if [[ -z "${seen[$item]:-}" ]]; then
+            echo "$item"
+            seen[$item]=1
+        fi
+    done
+}
+
 # Read failed tests from LastTestsFailed.log
 read_failed_tests_file() {
     local failed_file="$BUILD_DIR/Testing/Temporary/LastTestsFailed.log"
@@ -142,24 +352,17 @@ read_failed_tests_file() {
         fi
     done < "$failed_file"
 
-    # Remove duplicates while preserving order
-    declare -A seen
-    for test in "${tests[@]}"; do
-        if [[ -z "${seen[$test]:-}" ]]; then
-            echo "$test"
-            seen[$test]=1
-        fi
-    done
+    print_unique "${tests[@]}"
 }
 
-# Parse failed tests from ctest output
+# Parse failed tests from a saved ctest output log, one line at a time
 parse_failed_tests_from_output() {
-    local output="$1"
+    local log_path="$1"
     declare -a tests=()
     local in_section=0
 
     while IFS= read -r line; do
-        if [[ "$line" =~ ^The\ following\ tests\ FAILED: ]]; then
+        if [[ "${line#"${line%%[![:space:]]*}"}" == "The following tests FAILED:"* ]]; then
             in_section=1
             continue
         fi
@@ -177,51 +380,117 @@ parse_failed_tests_from_output() {
             # Empty line after section
             break
         fi
-    done <<< "$output"
+    done < "$log_path"
 
-    # Remove duplicates while preserving order
-    declare -A seen
-    for test in "${tests[@]}"; do
-        if [[ -z "${seen[$test]:-}" ]]; then
-            echo "$test"
-            seen[$test]=1
-        fi
-    done
+    print_unique "${tests[@]}"
+}
+
+# Print the case ID of the last marker belonging to test_name in stdin.
+# With stop_early=1 stop at the first line containing one, for input that
+# is fed in reverse line order.
+scan_case_markers() {
+    local test_name="$1"
+    local stop_early="$2"
+
+    # Pattern: "testsurroundingtext: Case 20" or "testkeyhandling: Case 4 - ..."
+    # The test name is looked up literally, so names containing characters
+    # such as "-", "." or "+" work too. It is passed through the environment
+    # because awk would interpret backslash escapes in a -v value.
+    CASE_TEST_NAME="$test_name" awk -v pattern="$CASE_PATTERN" -v stop_early="$stop_early" '
+        BEGIN { prefix = ENVIRON["CASE_TEST_NAME"] ":" }
+        {
+            found = ""
+            line = $0
+            while ((pos = index(line, prefix)) > 0) {
+                before = substr(line, pos - 1, 1)
+                line = substr(line, pos + length(prefix))
+                # Skip a longer name ending in this one, e.g. "footest:"
+                if (pos > 1 && before ~ /[A-Za-z0-9_.+-]/) {
+                    continue
+                }
+                if (match(line, pattern)) {
+                    marker = substr(line, RSTART, RLENGTH)
+                    sub(/.*Case[[:space:]]+/, "", marker)
+                    found = marker
+                }
+            }
+            if (found != "") {
+                last_case = found
+                if (stop_early) {
+                    exit
+                }
+            }
+        }
+        END { print last_case }
+    '
 }
 
-# Detect last case ID from test output
+# Detect last case ID from a test log.
+# Tests abort on the first failing case, so the marker is almost always near
+# the end: walk the tail of the log backwards and stop at the first marker
+# of test_name. Only if the tail has none is the whole log scanned.
 detect_last_case_id() {
-    local output="$1"
+    local log_path="$1"
     local test_name="$2"
-    local last_case=""
+    local case_id
 
-    # Pattern: "testsurroundingtext: Case 20" or "testkeyhandling: Case 4 - ..."
-    while IFS= read -r line; do
-        if [[ "$line" =~ $test_name:[[:space:]]*Case[[:space:]]+([0-9]+) ]]; then
-            last_case="${BASH_REMATCH[1]}"
+    case_id=$(tail -c "$CASE_SCAN_TAIL_BYTES" "$log_path" | tac | scan_case_markers "$test_name" 1) || true
+
+    if [[ -z "$case_id" && $(wc -c < "$log_path") -gt $CASE_SCAN_TAIL_BYTES ]]; then
+        case_id=$(scan_case_markers "$test_name" 0 < "$log_path")
+    fi
+    echo "$case_id"
+}
+
+# Split a "Test command:" line into the array named by $1.
+# CTest prints well-formed command lines, so plain ones are split on
+# whitespace; only lines with quotes or backslashes go through xargs, which
+# understands shell-like quoting. If xargs rejects the line, it is split on
+# whitespace and the quotes around each word are removed.
+split_command_line() {
+    local -n words_ref="$1"
+    local cmd_line="$2"
+
+    local i word
+
+    words_ref=()
+    if [[ "$cmd_line" == *[\"\'\\]* ]]; then
+        mapfile -d '' words_ref < <(xargs printf '%s\0' <<< "$cmd_line" 2>/dev/null)
+        if wait $!; then
+            return
         fi
-    done <<< "$output"
 
-    echo "$last_case"
+        # Unbalanced quotes somewhere: split on whitespace, and still unquote
+        # the words that are properly quoted on their own
+        read -ra words_ref <<< "$cmd_line"
+        for i in "${!words_ref[@]}"; do
+            word="${words_ref[$i]}"
+            if [[ ${#word} -ge 2 && ( "$word" == \"*\" || "$word" == \'*\' ) ]]; then
+                words_ref[$i]="${word:1:${#word}-2}"
+            fi
+        done
+        return
+    fi
+    read -ra words_ref <<< "$cmd_line"
 }
 
-# Get test command from CTest
+# Get test command from CTest. The lines may carry CTest's "N: " prefix.
 get_test_command() {
     local test_name="$1"
-    local regex="^${test_name}\$"
+    local regex="^${ESCAPED_TEST_NAMES[$test_name]:-$test_name}\$"
 
     local output
-    output=$(cd "$BUILD_DIR" && ctest -N -V -R "$regex" 2>&1 || true)
+    output=$(ctest -N -V -R "$regex" 2>&1 || true)
 
     local cmd_line=""
     local work_dir=""
 
     while IFS= read -r line; do
-        if [[ "$line" =~ ^Test\ command: ]]; then
-            cmd_line="${line#*: }"
+        if [[ "$line" =~ ^([0-9]+:\ )?Test\ command: ]]; then
+            cmd_line="${line#*Test command:}"
             cmd_line="${cmd_line#"${cmd_line%%[![:space:]]*}"}"
-        elif [[ "$line" =~ ^Working\ Directory: ]]; then
-            work_dir="${line#*: }"
+        elif [[ "$line" =~ ^([0-9]+:\ )?Working\ Directory: ]]; then
+            work_dir="${line#*Working Directory:}"
             work_dir="${work_dir#"${work_dir%%[![:space:]]*}"}"
         fi
     done <<< "$output"
@@ -230,9 +499,9 @@ get_test_command() {
     if [[ -z "$cmd_line" ]]; then
         local found=0
         while IFS= read -r line; do
-            if [[ "$line" =~ ^Test\ command: ]]; then
+            if [[ "$line" =~ ^([0-9]+:\ )?Test\ command: ]]; then
                 found=1
-                cmd_line="${line#*: }"
+                cmd_line="${line#*Test command:}"
                 cmd_line="${cmd_line#"${cmd_line%%[![:space:]]*}"}"
                 continue
             fi
@@ -262,7 +531,69 @@ get_test_command() {
     echo "$work_dir|$cmd_line"
 }
 
-# Run command and tee output to log file
+# Run "ctest -N -V" for the whole project once and cache its output.
+# Reruns may get here concurrently, so the cache is created under a lock.
+load_all_test_commands() {
+    {
+        flock 8
+        if [[ ! -f "$TEST_LIST_CACHE" ]]; then
+            ctest -N -V > "$TEST_LIST_CACHE.tmp" 2>&1 || true
+            mv "$TEST_LIST_CACHE.tmp" "$TEST_LIST_CACHE"
+        fi
+    } 8> "$LOGS_DIR/.test-list.lock"
+}
+
+# Look up the test command in the cached "ctest -N -V" output.
+# Prints "work_dir|cmd_line", or nothing if the test is not listed.
+lookup_test_command() {
+    local test_name="$1"
+
+    load_all_test_commands
+
+    local info
+    # Each test is listed as "N: Test command: ...", "N: Working Directory: ..."
+    # followed by its "Test #N: name" header
+    info=$(awk -v name="$test_name" '
+        /^([0-9]+: )?Test command:/ {
+            cmd = $0
+            sub(/^([0-9]+: )?Test command:[[:space:]]*/, "", cmd)
+            next
+        }
+        /^([0-9]+: )?Working Directory:/ {
+            dir = $0
+            sub(/^([0-9]+: )?Working Directory:[[:space:]]*/, "", dir)
+            next
+        }
+        /^[[:space:]]*Test[[:space:]]+#[0-9]+:/ {
+            header = $0
+            sub(/^[[:space:]]*Test[[:space:]]+#[0-9]+:[[:space:]]*/, "", header)
+            if (header == name && cmd != "") {
+                print dir "|" cmd
+                exit
+            }
+            cmd = ""
+            dir = ""
+        }
+    ' "$TEST_LIST_CACHE")
+
+    if [[ -z "$info" ]]; then
+        return
+    fi
+
+    if [[ "${info%%|*}" == "" ]]; then
+        if [[ -d "$BUILD_DIR/test" ]]; then
+            info="$BUILD_DIR/test$info"
+        else
+            info="$BUILD_DIR$info"
+        fi
+    fi
+    echo "$info"
+}
+
+# Run command and tee output to log file.
+# Output is copied through tee in raw blocks (no per-line processing, no
+# flush or fsync per write); the log is only read back as text afterwards.
+# Returns the exit code of the command, not of tee.
 run_tee() {
     local log_path="$1"
     shift
@@ -270,36 +601,425 @@ run_tee() {
 
     echo "$ ${cmd[*]}" > "$log_path"
     "${cmd[@]}" 2>&1 | tee -a "$log_path"
-    return "${PIPEFAIL[@]}"
+    return "${PIPESTATUS[0]}"
+}
+
+# Same as run_tee, but only write the output to the log file.
+# The log is opened once and the command writes straight to it, so nothing
+# is held in memory or copied through another process.
+run_tee_quiet() {
+    local log_path="$1"
+    shift
+    local cmd=("$@")
+
+    {
+        echo "$ ${cmd[*]}"
+        "${cmd[@]}" 2>&1
+    } > "$log_path"
+}
+
+# Print the names of the tests carrying a CTest label matching label
+list_labeled_tests() {
+    local label="$1"
+
+    ctest -N -L "$label" 2>/dev/null |
+        sed -n 's/^[[:space:]]*Test[[:space:]]*#[0-9]*:[[:space:]]*//p' || true
+}
+
+# Tests carrying one of the --only labels, loaded on first use
+declare -A ONLY_TESTS=()
+ONLY_TESTS_LOADED=0
+
+load_only_tests() {
+    local label test
+
+    if [[ $ONLY_TESTS_LOADED -eq 1 ]]; then
+        return
+    fi
+    for label in "${ONLY_LABELS[@]}"; do
+        while IFS= read -r test; do
+            ONLY_TESTS[$test]=1
+        done < <(list_labeled_tests "$label")
+    done
+    ONLY_TESTS_LOADED=1
+}
+
+# Check whether a failed test matches --grep and carries one of the --only
+# labels
+test_selected() {
+    local test="$1"
+
+    if [[ -n "$GREP" && ! "$test" =~ $GREP ]]; then
+        return 1
+    fi
+    if [[ ${#ONLY_LABELS[@]} -gt 0 ]]; then
+        load_only_tests
+        if [[ -z "${ONLY_TESTS[$test]:-}" ]]; then
+            return 1
+        fi
+    fi
+    return 0
+}
+
+# Keep only the failed tests selected by --grep / --only
+filter_failed_tests() {
+    local -a kept=()
+    local test
+
+    for test in "${failed_tests[@]}"; do
+        if test_selected "$test"; then
+            kept+=("$test")
+        fi
+    done
+    failed_tests=("${kept[@]}")
+}
+
+# Report the result of a PASS 2 rerun and, if possible, rerun just its
+# failing case. Returns the given exit code of the rerun.
+report_rerun() {
+    local test_name="$1"
+    local log_path="$2"
+    local rc="$3"
+    local rc2
+
+    if [[ $rc -ne 0 ]]; then
+        echo
+        echo -e "${RED}[FAILED]${NC} $test_name (exit=$rc)"
+
+        local case_id=""
+        if [[ $NO_CASE_PASS -eq 0 ]]; then
+            # An empty log cannot contain a case marker
+            if [[ -s "$log_path" ]]; then
+                case_id=$(detect_last_case_id "$log_path" "$test_name")
+            fi
+            if [[ -z "$case_id" ]]; then
+                echo "Could not detect failing case id from output; skipping case-only rerun."
+            fi
+        fi
+
+        # Only tests following the "Case N" convention need the test command
+        if [[ $NO_CASE_PASS -eq 0 && -n "$case_id" ]]; then
+            echo "Detected failing case: $test_name case $case_id"
+
+            # Get test command, querying CTest for this test only if it
+            # is missing from the cached test list
+            local info work_dir cmd_line
+            info=$(lookup_test_command "$test_name")
+            if [[ -z "$info" ]]; then
+                info=$(get_test_command "$test_name")
+            fi
+            work_dir="${info%%|*}"
+            cmd_line="${info#*|}"
+
+            local -a case_cmd
+            split_command_line case_cmd "$cmd_line"
+            case_cmd+=("--case" "$case_id")
+
+            local case_log="$LOGS_DIR/pass2.${test_name}.case${case_id}.log"
+            echo "$ ${case_cmd[*]}"
+
+            set +e
+            cd "$work_dir" && run_tee "$case_log" "${case_cmd[@]}"
+            rc2=$?
+            cd "$BUILD_DIR"
+            set -e
+
+            if [[ $rc2 -ne 0 ]]; then
+                echo -e "${RED}[FAILED]${NC} case-only rerun also failed: $test_name case $case_id (exit=$rc2)"
+            else
+                echo -e "${GREEN}[OK]${NC} case-only rerun passed: $test_name case $case_id"
+            fi
+            echo "Case log saved: $case_log"
+        fi
+    else
+        echo
+        echo -e "${GREEN}[OK]${NC} $test_name"
+    fi
+    echo "Log saved: $log_path"
+    return "$rc"
+}
+
+# Rerun a single failed test (and, if possible, its failing case).
+# Returns the exit code of the ctest rerun.
+rerun_one() {
+    local test_name="$1"
+    local idx="$2"
+    local num=$((idx+1))
+    local total=${#failed_tests[@]}
+
+    if [[ $EARLY_RERUN -eq 1 ]]; then
+        # The list keeps growing while PASS 1 runs, there is no total yet
+        echo
+        echo "[$num] Rerunning: $test_name"
+    elif [[ $PAUSE -eq 0 ]]; then
+        echo
+        echo "[$num/$total] Rerunning: $test_name"
+    fi
+
+    local regex="^${ESCAPED_TEST_NAMES[$test_name]:-$test_name}\$"
+    local log_path="$LOGS_DIR/pass2.${test_name}.log"
+
+    local pass2_cmd=(ctest -R "$regex" -VV --output-on-failure "${CTEST_ARGS[@]}")
+
+    local rc
+    set +e
+    run_tee "$log_path" "${pass2_cmd[@]}"
+    rc=$?
+    set -e
+
+    report_rerun "$test_name" "$log_path" "$rc"
+}
+
+# Report a test from the batched PASS 2 run, using the per-test log split
+# out of pass2.all.log and the status recorded in BATCH_RC.
+report_batched() {
+    local test_name="$1"
+    local idx="$2"
+    local log_path="$LOGS_DIR/pass2.${test_name}.log"
+    local rc="${BATCH_RC[$test_name]:-$batch_rc}"
+
+    echo
+    echo "[$((idx+1))/${#failed_tests[@]}] $test_name"
+    if [[ ! -f "$log_path" ]]; then
+        echo "Test did not run in the batched rerun."
+        : > "$log_path"
+    fi
+
+    report_rerun "$test_name" "$log_path" "$rc"
+}
+
+# Run a PASS 2 job (rerun_one or report_batched) for a failed test in the
+# background, buffering its output and flushing it in one piece once done so
+# that concurrent jobs don't interleave.
+# The exit code is stored in $LOGS_DIR/.pass2.<idx>.rc
+run_buffered() {
+    local job="$1"
+    local test_name="$2"
+    local idx="$3"
+    local out="$LOGS_DIR/.pass2.${idx}.out"
+    local rc=0
+
+    "$job" "$test_name" "$idx" > "$out" 2>&1 || rc=$?
+    echo "$rc" > "$LOGS_DIR/.pass2.${idx}.rc"
+
+    { flock 9; cat "$out"; } 9> "$LOGS_DIR/.stdout.lock"
+    rm -f "$out"
+}
+
+# Run a PASS 2 job for every failed test through a pool of workers and
+# collect the exit codes into overall_rc
+run_pool() {
+    local job="$1"
+    local workers running=0 idx
+
+    workers=$WORKERS
+    for idx in "${!failed_tests[@]}"; do
+        if (( running >= workers )); then
+            wait -n || true
+            running=$((running-1))
+        fi
+        run_buffered "$job" "${failed_tests[$idx]}" "$idx" &
+        running=$((running+1))
+    done
+    wait
+    collect_pool_results
+}
+
+# Collect the exit codes left by run_buffered into overall_rc
+collect_pool_results() {
+    local idx rc rc_file
+
+    for idx in "${!failed_tests[@]}"; do
+        rc_file="$LOGS_DIR/.pass2.${idx}.rc"
+        rc=$(<"$rc_file")
+        rm -f "$rc_file"
+        if [[ $rc -ne 0 ]]; then
+            overall_rc=$rc
+        fi
+    done
+    rm -f "$LOGS_DIR/.stdout.lock"
+}
+
+# Print the names of the tests reported as failed so far in a (non -Q)
+# ctest output log, from result lines such as
+# "  2/4 Test #3: testfoo ..........***Failed    1.00 sec"
+list_reported_failures() {
+    local log_path="$1"
+
+    awk '
+        /^[[:space:]]*[0-9]+\/[0-9]+[[:space:]]+Test[[:space:]]+#[0-9]+: .*\*\*\*/ {
+            name = $0
+            sub(/^[^#]*#[0-9]+:[[:space:]]*/, "", name)
+            sub(/[[:space:]]+\.*[[:space:]]*\*\*\*.*$/, "", name)
+            print name
+        }
+    ' "$log_path"
+}
+
+# Append the failures newly reported in the PASS 1 log to failed_tests,
+# if they pass the --grep / --only filters
+queue_reported_failures() {
+    local test_name
+    local -a new_tests=()
+
+    while IFS= read -r test_name; do
+        if [[ -z "${early_seen[$test_name]:-}" ]]; then
+            early_seen[$test_name]=1
+            if test_selected "$test_name"; then
+                new_tests+=("$test_name")
+            fi
+        fi
+    done < <(list_reported_failures "$LOGS_DIR/pass1.log")
+
+    escape_test_names "${new_tests[@]}"
+    failed_tests+=("${new_tests[@]}")
+}
+
+# Number of early reruns started so far; failed_tests[0 .. n-1] are running
+# or done
+EARLY_DISPATCHED=0
+
+# Start early reruns for the entries of failed_tests not started yet, as
+# long as fewer than (cores - 2) are still running. Finished reruns are
+# the ones that already left their .rc file.
+dispatch_pending_reruns() {
+    local workers finished
+    local -a rc_files
+
+    workers=$WORKERS
+    while [[ $EARLY_DISPATCHED -lt ${#failed_tests[@]} ]]; do
+        rc_files=("$LOGS_DIR"/.pass2.*.rc)
+        finished=0
+        if [[ -e "${rc_files[0]}" ]]; then
+            finished=${#rc_files[@]}
+        fi
+        if [[ $((EARLY_DISPATCHED - finished)) -ge $workers ]]; then
+            return
+        fi
+        run_buffered rerun_one "${failed_tests[$EARLY_DISPATCHED]}" "$EARLY_DISPATCHED" &
+        EARLY_DISPATCHED=$((EARLY_DISPATCHED+1))
+    done
+}
+
+# Split the output of the batched ctest run into one log per test.
+# With -VV every output line of test N is prefixed with "N: ", and the test
+# is announced by "Start N: name" and closed by its "Test #N: name" result
+# line. Prints "name<TAB>status" for each finished test (0 = passed).
+split_batched_log() {
+    local all_log="$1"
+
+    # The "$ ctest ..." header line is read inside awk: passed with -v, the
+    # backslashes of the escaped -R alternation would be interpreted
+    awk -v logs_dir="$LOGS_DIR" '
+        NR == 1 {
+            header = $0
+            next
+        }
+        /^[[:space:]]*Start[[:space:]]+[0-9]+: / {
+            line = $0
+            sub(/^[[:space:]]*Start[[:space:]]+/, "", line)
+            num = line
+            sub(/:.*/, "", num)
+            sub(/^[0-9]+: /, "", line)
+            name[num] = line
+            path[num] = logs_dir "/pass2." line ".log"
+            print header > path[num]
+            print $0 > path[num]
+            next
+        }
+        /^[0-9]+: / {
+            num = $0
+            sub(/:.*/, "", num)
+            if (num in path) {
+                print $0 > path[num]
+            }
+            next
+        }
+        /^[[:space:]]*[0-9]+\/[0-9]+[[:space:]]+Test[[:space:]]+#[0-9]+: / {
+            num = $0
+            sub(/^[^#]*#/, "", num)
+            sub(/:.*/, "", num)
+            if (num in path) {
+                print $0 > path[num]
+                close(path[num])
+                status = ($0 ~ /[[:space:]]Passed([[:space:]]|$)/) ? 0 : 1
+                print name[num] "\t" status
+                delete path[num]
+            }
+        }
+    ' "$all_log"
 }
 
 # ========== PASS 1: Quick scan ==========
-echo "== PASS 1: running CTest (quiet) to identify failures =="
-pass1_cmd=(ctest -Q "${CTEST_ARGS[@]}")
+if [[ $EARLY_RERUN -eq 1 ]]; then
+    echo "== PASS 1: running CTest (output to log only), rerunning failures as they appear =="
+    # Per-test result lines are needed to spot failures while CTest runs;
+    # the output only goes to the log either way
+    pass1_cmd=(ctest "${AUTO_JOBS_ARGS[@]}" "${CTEST_ARGS[@]}")
+else
+    echo "== PASS 1: running CTest (quiet) to identify failures =="
+    pass1_cmd=(ctest -Q "${AUTO_JOBS_ARGS[@]}" "${CTEST_ARGS[@]}")
+fi
 echo "$ ${pass1_cmd[*]}"
 
-pass1_output=$(cd "$BUILD_DIR" && "${pass1_cmd[@]}" 2>&1) || pass1_rc=$?
-pass1_rc=${pass1_rc:-0}
-echo "$pass1_output" > "$LOGS_DIR/pass1.log"
+pass1_rc=0
+failed_tests=()
+if [[ $EARLY_RERUN -eq 1 ]]; then
+    # CTest only writes LastTestsFailed.log at the end, so poll the PASS 1
+    # log for failed tests and rerun them while the rest of the suite runs
+    overall_rc=0
+    declare -A early_seen=()
+    echo "Rerunning failed tests as soon as PASS 1 reports them."
 
-if [[ $pass1_rc -eq 0 ]]; then
+    run_tee_quiet "$LOGS_DIR/pass1.log" "${pass1_cmd[@]}" &
+    pass1_pid=$!
+    while kill -0 "$pass1_pid" 2>/dev/null; do
+        sleep "$EARLY_POLL_INTERVAL"
+        queue_reported_failures
+        dispatch_pending_reruns
+    done
+    wait "$pass1_pid" || pass1_rc=$?
+    # Collect the failures reported after the last poll as well
+    queue_reported_failures
+else
+    run_tee_quiet "$LOGS_DIR/pass1.log" "${pass1_cmd[@]}" || pass1_rc=$?
+fi
+early_tests=("${failed_tests[@]}")
+
+if [[ $pass1_rc -eq 0 && ${#early_tests[@]} -eq 0 ]]; then
     echo
     echo "PASS 1 succeeded: no failing tests."
     exit 0
 fi
 
-# Identify failures
-mapfile -t failed_tests < <(read_failed_tests_file)
+# Identify failures. Early reruns also write Testing/Temporary, so once one
+# has started LastTestsFailed.log can't be trusted and the list comes from
+# the complete PASS 1 log instead.
+if [[ $EARLY_DISPATCHED -gt 0 ]]; then
+    failed_tests=()
+else
+    mapfile -t failed_tests < <(read_failed_tests_file)
+fi
 
 if [[ ${#failed_tests[@]} -eq 0 ]]; then
-    mapfile -t failed_tests < <(parse_failed_tests_from_output "$pass1_output")
+    mapfile -t failed_tests < <(parse_failed_tests_from_output "$LOGS_DIR/pass1.log")
+fi
+
+# Early reruns keep their place at the front of the list
+if [[ ${#early_tests[@]} -gt 0 ]]; then
+    mapfile -t failed_tests < <(print_unique "${early_tests[@]}" "${failed_tests[@]}")
 fi
 
 if [[ ${#failed_tests[@]} -eq 0 ]]; then
     echo >&2
     echo "Error: PASS 1 failed, but could not determine failed test list." >&2
     echo "Saved PASS 1 output to: $LOGS_DIR/pass1.log" >&2
-    echo "Tip: check $BUILD_DIR/Testing/Temporary/LastTest.log, or rerun with: ctest --output-on-failure -VV" >&2
+    if [[ $EARLY_RERUN -eq 1 ]]; then
+        # Early reruns have overwritten Testing/Temporary/LastTest.log
+        echo "Tip: check $LOGS_DIR/pass1.log, or rerun with: ctest --output-on-failure -VV" >&2
+    else
+        echo "Tip: check $BUILD_DIR/Testing/Temporary/LastTest.log, or rerun with: ctest --output-on-failure -VV" >&2
+    fi
     exit "${pass1_rc:-1}"
 fi
 
@@ -315,79 +1035,97 @@ if [[ $NO_SECOND_PASS -eq 1 ]]; then
     exit "${pass1_rc:-1}"
 fi
 
+# Only rerun the failures the user is interested in
+if [[ ${#ONLY_LABELS[@]} -gt 0 || -n "$GREP" ]]; then
+    total_failed=${#failed_tests[@]}
+    filter_failed_tests
+    if [[ ${#failed_tests[@]} -eq 0 ]]; then
+        echo
+        echo "No failed test matches --only/--grep; skipping PASS 2. Logs: $LOGS_DIR"
+        exit "${pass1_rc:-1}"
+    fi
+    echo
+    echo "Rerunning ${#failed_tests[@]} of $total_failed failed tests (--only/--grep):"
+    for i in "${!failed_tests[@]}"; do
+        echo "  $((i+1)). ${failed_tests[$i]}"
+    done
+fi
+
 # ========== PASS 2: Rerun each failed test ==========
-overall_rc=0
+
+if [[ $EARLY_RERUN -eq 0 ]]; then
+    overall_rc=0
+fi
 echo
-echo "== PASS 2: rerunning each failed test individually (-VV --output-on-failure) =="
 
-for idx in "${!failed_tests[@]}"; do
-    test_name="${failed_tests[$idx]}"
-    num=$((idx+1))
-    total=${#failed_tests[@]}
+# Every rerun selects its test with -R, escape all names once up front
+escape_test_names "${failed_tests[@]}"
 
-    if [[ $PAUSE -eq 1 ]]; then
-        echo
-        read -r -p "[$num/$total] Press Enter to rerun: $test_name "
-    else
-        echo
-        echo "[$num/$total] Rerunning: $test_name"
+# One ctest invocation for all failed tests saves the CTest startup cost
+# of each rerun, unless the name alternation gets too long for CTest's
+# regular expression engine
+if [[ $BATCHED -eq 1 && $PAUSE -eq 0 && $EARLY_RERUN -eq 0 ]]; then
+    escaped_tests=()
+    for test_name in "${failed_tests[@]}"; do
+        escaped_tests+=("${ESCAPED_TEST_NAMES[$test_name]}")
+    done
+    batch_regex="^($(IFS='|'; echo "${escaped_tests[*]}"))\$"
+    if [[ ${#batch_regex} -gt $BATCH_REGEX_MAX ]]; then
+        echo "Too many failed tests for a single ctest -R, rerunning them individually."
+        BATCHED=0
     fi
+fi
 
-    regex="^${test_name}\$"
-    log_path="$LOGS_DIR/pass2.${test_name}.log"
-
-    pass2_cmd=(ctest -R "$regex" -VV --output-on-failure "${CTEST_ARGS[@]}")
+if [[ $EARLY_RERUN -eq 1 ]]; then
+    echo "== PASS 2: rerunning the remaining failed tests individually (-VV --output-on-failure) =="
 
-    set +e
-    (cd "$BUILD_DIR" && run_tee "$log_path" "${pass2_cmd[@]}")
-    rc=$?
-    set -e
+    dispatch_pending_reruns
+    while [[ $EARLY_DISPATCHED -lt ${#failed_tests[@]} ]]; do
+        wait -n || true
+        dispatch_pending_reruns
+    done
+    wait
+    collect_pool_results
+elif [[ $PAUSE -eq 1 ]]; then
+    echo "== PASS 2: rerunning each failed test individually (-VV --output-on-failure) =="
 
-    if [[ $rc -ne 0 ]]; then
-        overall_rc=$rc
+    # Interactive mode stays serial
+    for idx in "${!failed_tests[@]}"; do
         echo
-        echo -e "${RED}[FAILED]${NC} $test_name (exit=$rc)"
-
-        if [[ $NO_CASE_PASS -eq 0 ]]; then
-            output=$(<"$log_path")
-            case_id=$(detect_last_case_id "$output" "$test_name")
-
-            if [[ -z "$case_id" ]]; then
-                echo "Could not detect failing case id from output; skipping case-only rerun."
-            else
-                echo "Detected failing case: $test_name case $case_id"
+        read -r -p "[$((idx+1))/${#failed_tests[@]}] Press Enter to rerun: ${failed_tests[$idx]} "
+        rerun_one "${failed_tests[$idx]}" "$idx" || overall_rc=$?
+    done
+elif [[ $BATCHED -eq 1 ]]; then
+    echo "== PASS 2: rerunning all failed tests in one ctest run (-VV --output-on-failure) =="
 
-                # Get test command
-                info=$(get_test_command "$test_name")
-                work_dir="${info%%|*}"
-                cmd_line="${info#*|}"
+    all_log="$LOGS_DIR/pass2.all.log"
+    pass2_cmd=(ctest -R "$batch_regex" -VV --output-on-failure "${AUTO_JOBS_ARGS[@]}" "${CTEST_ARGS[@]}")
 
-                # Parse command line (simple split on spaces, good enough for this use case)
-                read -ra case_cmd <<< "$cmd_line"
-                case_cmd+=("--case" "$case_id")
+    batch_rc=0
+    run_tee "$all_log" "${pass2_cmd[@]}" || batch_rc=$?
 
-                case_log="$LOGS_DIR/pass2.${test_name}.case${case_id}.log"
-                echo "$ ${case_cmd[*]}"
+    declare -A BATCH_RC=()
+    while IFS=$'\t' read -r test_name status; do
+        if [[ $status -eq 0 ]]; then
+            BATCH_RC[$test_name]=0
+        else
+            BATCH_RC[$test_name]=$batch_rc
+        fi
+    done < <(split_batched_log "$all_log")
 
-                set +e
-                (cd "$work_dir" && run_tee "$case_log" "${case_cmd[@]}")
-                rc2=$?
-                set -e
+    # Tests that still fail may need a case-only rerun; those are independent
+    echo
+    echo "Reporting results; case-only reruns use up to $WORKERS workers."
+    run_pool report_batched
+    echo
+    echo "Combined PASS 2 log: $all_log"
+else
+    echo "== PASS 2: rerunning each failed test individually (-VV --output-on-failure) =="
 
-                if [[ $rc2 -ne 0 ]]; then
-                    echo -e "${RED}[FAILED]${NC} case-only rerun also failed: $test_name case $case_id (exit=$rc2)"
-                else
-                    echo -e "${GREEN}[OK]${NC} case-only rerun passed: $test_name case $case_id"
-                fi
-                echo "Case log saved: $case_log"
-            fi
-        fi
-    else
-        echo
-        echo -e "${GREEN}[OK]${NC} $test_name"
-    fi
-    echo "Log saved: $log_path"
-done
+    # Reruns are independent, run them through a pool of (cores - 2) workers
+    echo "Running up to $WORKERS reruns in parallel; output is shown as each one finishes."
+    run_pool rerun_one
+fi
 
 echo
 echo "Done. PASS 1 log: $LOGS_DIR/pass1.log"